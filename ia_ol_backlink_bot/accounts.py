@@ -0,0 +1,167 @@
+"""
+Bot accounts, and spreading edition saves across them.
+
+Each account logs in with its own openlibrary-client session and has its own rate limiter, so
+with N bot accounts the bot can make roughly N times as many edits as it could with one.
+"""
+import os
+import queue
+import threading
+import time
+from collections import namedtuple
+from collections.abc import Callable, Iterable, Iterator, Mapping
+from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
+                                wait)
+from contextlib import contextmanager
+from itertools import islice
+from typing import Any, TypeVar
+
+from olclient.openlibrary import OpenLibrary
+from requests.exceptions import HTTPError
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+Credentials = namedtuple("Credentials", ["username", "password"])
+
+# Open Library answers with one of these when a session cookie is no longer valid.
+EXPIRED_SESSION_CODES = (401, 403)
+
+
+def get_bot_credentials(environ: Mapping[str, str] = os.environ) -> list[Credentials]:
+    """
+    Read the bot credentials from the environment.
+
+    The first account is always bot_user/bot_password. Additional accounts can be added as
+    bot_user_2/bot_password_2, bot_user_3/bot_password_3, etc. Numbering stops at the first gap.
+    """
+    credentials = [Credentials(environ["bot_user"], environ["bot_password"])]
+
+    n = 2
+    while f"bot_user_{n}" in environ:
+        credentials.append(Credentials(environ[f"bot_user_{n}"], environ[f"bot_password_{n}"]))
+        n += 1
+
+    return credentials
+
+
+class RateLimiter:
+    """Allow at most one call to wait() to return every {delay} seconds."""
+
+    def __init__(self, delay: float) -> None:
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._next_allowed = 0.0
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if self._next_allowed > now:
+                time.sleep(self._next_allowed - now)
+            self._next_allowed = max(now, self._next_allowed) + self.delay
+
+
+class BotAccount:
+    """A single logged in bot account with its own session and rate limiter."""
+
+    def __init__(self, credentials: Credentials, base_url: str, delay: float) -> None:
+        self.credentials = credentials
+        self.ol = OpenLibrary(base_url=base_url, credentials=credentials)
+        self.rate_limiter = RateLimiter(delay)
+
+    @property
+    def username(self) -> str:
+        return str(self.credentials.username)
+
+    def login(self) -> None:
+        self.ol.login(self.credentials)
+
+    def save(self, edition: Any, comment: str) -> None:
+        """
+        Save {edition}, which must have been fetched with self.ol, waiting on the rate limiter first.
+        If the session has expired, log in again and retry once.
+        """
+        self.rate_limiter.wait()
+        try:
+            edition.save(comment=comment)
+        except HTTPError as e:
+            if e.response is None or e.response.status_code not in EXPIRED_SESSION_CODES:
+                raise
+
+            print(f"Session for {self.username} expired. Logging in again.")
+            self.login()
+            self.rate_limiter.wait()
+            edition.save(comment=comment)
+
+
+class AccountPool:
+    """
+    Hand out bot accounts so each is only used by one thread at a time, and run work across
+    all of them at once.
+    """
+
+    def __init__(self, accounts: list[BotAccount]) -> None:
+        if not accounts:
+            raise ValueError("AccountPool needs at least one account.")
+
+        self.accounts = accounts
+        self._idle: queue.Queue[BotAccount] = queue.Queue()
+        for account in accounts:
+            self._idle.put(account)
+
+    def __len__(self) -> int:
+        return len(self.accounts)
+
+    @contextmanager
+    def checkout(self) -> Iterator[BotAccount]:
+        """Block until an account is free, and return it to the pool when done."""
+        account = self._idle.get()
+        try:
+            yield account
+        finally:
+            self._idle.put(account)
+
+    def map(self, func: Callable[[T, BotAccount], R], items: Iterable[T]) -> Iterator[tuple[T, R]]:
+        """
+        Call func(item, account) for each item, with as many calls in flight as there are accounts.
+        Yields (item, result) as each call finishes, so the caller can record the results on its
+        own thread. If any call raises, every other result is still yielded before the first
+        exception is re-raised.
+
+        Items are only submitted as earlier calls finish, so if the caller stops early (e.g. on
+        Ctrl-C), only the calls already in flight still run.
+        """
+
+        def run(item: T) -> R:
+            with self.checkout() as account:
+                return func(item, account)
+
+        remaining = iter(items)
+        error: BaseException | None = None
+        executor = ThreadPoolExecutor(max_workers=len(self))
+        try:
+            pending: dict[Future[R], T] = {executor.submit(run, item): item for item in islice(remaining, len(self))}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    # Keep the accounts busy while the caller records this result.
+                    for next_item in islice(remaining, 1):
+                        pending[executor.submit(run, next_item)] = next_item
+
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        error = error or e
+                        continue
+                    yield item, result
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+        if error is not None:
+            raise error
+
+
+def get_account_pool(credentials: list[Credentials], base_url: str, delay: float) -> AccountPool:
+    """Log in to each account in {credentials} and pool them."""
+    return AccountPool([BotAccount(c, base_url=base_url, delay=delay) for c in credentials])
@@ -108,6 +108,6 @@ async def create_item(unprocessed_backlinks: list[POSTedBacklinkItem]):
     See https://host/docs for OpenAPI docs.
     """
     parsed_input = parse_json_backlink_items(unprocessed_backlinks)
-    populate_db(parsed_input, db=DB)
+    populate_db(parsed_input, db=DB, source="api")
 
     return {"status": "success"}
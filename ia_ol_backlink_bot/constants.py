@@ -1,10 +1,33 @@
+from functools import cache
 from pathlib import Path
+from typing import Any
 
 import toml
 from database import Database
-from olclient.openlibrary import OpenLibrary
 
-SETTINGS: dict[str, str] = toml.loads(Path("pyproject.toml").read_text(encoding="utf-8"))["tool"]["backlink"]
-API_KEYS_FILE = SETTINGS["api_key_file"]
-DB_NAME = "files/" + SETTINGS["sqlite"]
-DB = Database(name=DB_NAME)
+# SETTINGS, API_KEYS_FILE, DB_NAME and DB are computed on first access (see __getattr__ below), so that
+# importing this module neither parses pyproject.toml nor opens the database.
+
+
+@cache
+def get_settings() -> dict[str, str]:
+    settings: dict[str, str] = toml.loads(Path("pyproject.toml").read_text(encoding="utf-8"))["tool"]["backlink"]
+    return settings
+
+
+@cache
+def get_db() -> Database:
+    return Database(name="files/" + get_settings()["sqlite"])
+
+
+def __getattr__(name: str) -> Any:
+    if name == "SETTINGS":
+        return get_settings()
+    if name == "API_KEYS_FILE":
+        return get_settings()["api_key_file"]
+    if name == "DB_NAME":
+        return "files/" + get_settings()["sqlite"]
+    if name == "DB":
+        return get_db()
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
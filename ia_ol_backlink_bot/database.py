@@ -1,10 +1,11 @@
 import sqlite3
 from collections.abc import Iterable, Iterator
+from pathlib import Path
 from typing import Any
 
-from ia_ol_backlink_bot.helpers import (delete_file, get_input_filename,
-                                        parse_tsv)
-from ia_ol_backlink_bot.models import BacklinkItemRow
+from ia_ol_backlink_bot.helpers import (delete_file, file_sha256,
+                                        get_input_filename, parse_tsv)
+from ia_ol_backlink_bot.models import BacklinkItemRow, EditRecord
 
 
 class Database:
@@ -15,6 +16,7 @@ class Database:
 
     def __init__(self, name: str):
 
+        self.name = name
         self._conn = sqlite3.connect(name, timeout=60)
         self._cursor = self._conn.cursor()
 
@@ -40,7 +42,7 @@ class Database:
             self.commit()
         self.connection.close()
 
-    def execute(self, sql: str, params: tuple[str] | None = None) -> None:
+    def execute(self, sql: str, params: tuple[Any, ...] | None = None) -> None:
         self.cursor.execute(sql, params or ())
 
     def executemany(self, sql: str, params: tuple[str] | Iterable[str] | None = None) -> None:
@@ -52,7 +54,7 @@ class Database:
     def fetchone(self) -> Any:
         return self.cursor.fetchone()
 
-    def query(self, sql: str, params: tuple[str] | None = None) -> list[Any]:
+    def query(self, sql: str, params: tuple[Any, ...] | None = None) -> list[Any]:
         self.cursor.execute(sql, params or ())
         return self.fetchall()
 
@@ -60,10 +62,16 @@ class Database:
         return self.cursor.lastrowid
 
 
-def populate_db(parsed_input: Iterator[BacklinkItemRow], db: Database) -> None:
+def populate_db(
+    parsed_input: Iterator[BacklinkItemRow], db: Database, source: str | None = None, sha256: str | None = None
+) -> None:
     """
     Populate the DB with items to process. Once in the database, the functions called
     from main() will process them.
+
+    The rows inserted are recorded as a batch, along with {source} (e.g. the input filename) and
+    the {sha256} of the input file, so that the batch can later be rolled back (see
+    get_edits_to_roll_back()), and the same file isn't added twice (see file_imported()).
     """
     # Create the DB if necessary, or use the existing one.
     try:
@@ -73,13 +81,45 @@ def populate_db(parsed_input: Iterator[BacklinkItemRow], db: Database) -> None:
         )
 
         db.executemany("INSERT INTO link_items (edition_id, ocaid, status) VALUES (?, ?, ?)", parsed_input)
+        inserted = db.cursor.rowcount
         db.execute("CREATE INDEX idx_status ON link_items(status)")
         db.execute("CREATE INDEX idx ON link_items(rowid)")
-        db.commit()
 
     except sqlite3.OperationalError:
         db.executemany("INSERT INTO link_items (edition_id, ocaid, status) VALUES (?, ?, ?)", parsed_input)
-        db.commit()
+        inserted = db.cursor.rowcount
+
+    # The insert is a single transaction, so its rowids are contiguous and end at MAX(rowid).
+    create_history_tables(db)
+    if inserted > 0:
+        last_rowid = db.query("SELECT MAX(rowid) FROM link_items")[0][0]
+        db.execute(
+            "INSERT INTO import_batches (source, sha256, first_rowid, last_rowid) VALUES (?, ?, ?, ?)",
+            (source, sha256, last_rowid - inserted + 1, last_rowid),
+        )
+
+    db.commit()
+
+
+def create_history_tables(db: Database) -> None:
+    """
+    Create, if needed, the tables used to roll back edits:
+        import_batches: the range of link_items rowids added by each call to populate_db().
+        edit_history: what each Edition looked like before this script edited it, and rollback_status:
+            0: not rolled back
+            1: rolled back by this script
+            2: not rolled back, because something else has changed the Edition since
+            3: there was an error rolling back this entry.
+            4: not rolled back, because the edit was never saved (e.g. the save failed).
+    """
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS import_batches (batch_id INTEGER PRIMARY KEY, source TEXT, sha256 TEXT, \
+            first_rowid INTEGER, last_rowid INTEGER)"
+    )
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS edit_history (link_item_id INTEGER PRIMARY KEY, edition_id TEXT, \
+            ocaid TEXT, prior_ocaid TEXT, prior_revision INTEGER, rollback_status INTEGER DEFAULT 0)"
+    )
 
 
 def get_backitems_needing_update(db: Database) -> list[Any]:
@@ -94,12 +134,83 @@ def update_backlink_item_status(status: int, rowid: int, db: Database) -> None:
         1: added by this script
         2: added elsewhere (i.e. the parsed TSV said the Edition needed linking, but something else updated it.)
         3: there was an error processing this entry.
+        4: added by this script, then rolled back by it.
     """
 
     db.execute(f"UPDATE link_items SET status = {status} WHERE rowid = {rowid}")
     db.commit()
 
 
+def file_imported(sha256: str, db: Database) -> bool:
+    """Return True if populate_db() has already added items from a file with contents matching {sha256}."""
+    create_history_tables(db)
+    return len(db.query("SELECT 1 FROM import_batches WHERE sha256 = ? LIMIT 1", (sha256,))) > 0
+
+
+def record_edit(edit: EditRecord, db: Database) -> None:
+    """
+    Record the state of an Edition before this script edits it. Requires create_history_tables().
+    prior_ocaid is NULL if the Edition had no ocaid field at all.
+    """
+    db.execute(
+        "INSERT OR REPLACE INTO edit_history (link_item_id, edition_id, ocaid, prior_ocaid, prior_revision) \
+            VALUES (?, ?, ?, ?, ?)",
+        (edit.link_item_id, edit.edition_id, edit.ocaid, edit.prior_ocaid, edit.prior_revision),
+    )
+    db.commit()
+
+
+def get_edits_to_roll_back(
+    db: Database,
+    source: str | None = None,
+    batch_id: int | None = None,
+    rowid_range: tuple[int, int] | None = None,
+) -> list[EditRecord]:
+    """
+    Get the edits made by this script that haven't been rolled back, selected by the source of
+    their batch (e.g. the input filename), by batch_id, or by an inclusive range of link_items rowids.
+    Exactly one selector should be given.
+
+    Edits whose rollback errored are selected again, so re-running a rollback retries them. Edits
+    are selected whatever their link_items status, as an edit is recorded before it's saved, and
+    the status may not have been recorded after it. rollback_edit() checks what's on Open Library.
+    """
+    create_history_tables(db)
+    sql = """SELECT h.link_item_id, h.edition_id, h.ocaid, h.prior_ocaid, h.prior_revision
+        FROM edit_history h
+        WHERE h.rollback_status IN (0, 3) AND """
+    in_batch = "EXISTS (SELECT 1 FROM import_batches b WHERE b.{} = ? \
+        AND h.link_item_id BETWEEN b.first_rowid AND b.last_rowid)"
+
+    params: tuple[Any, ...]
+    if source is not None:
+        sql += in_batch.format("source")
+        params = (source,)
+    elif batch_id is not None:
+        sql += in_batch.format("batch_id")
+        params = (batch_id,)
+    elif rowid_range is not None:
+        sql += "h.link_item_id BETWEEN ? AND ?"
+        params = rowid_range
+    else:
+        raise ValueError("One of source, batch_id or rowid_range is required.")
+
+    return [EditRecord(*row) for row in db.query(sql + " ORDER BY h.link_item_id", params)]
+
+
+def update_rollback_status(status: int, edit: EditRecord, db: Database) -> None:
+    """
+    Record the outcome of rolling back {edit}. See create_history_tables() for rollback_status values.
+    Each outcome is committed as it happens, so an interrupted rollback resumes where it left off.
+
+    The link_items status only becomes 4 if it was 1, so that e.g. the record of an error isn't overwritten.
+    """
+    db.execute("UPDATE edit_history SET rollback_status = ? WHERE link_item_id = ?", (status, edit.link_item_id))
+    if status == 1:
+        db.execute("UPDATE link_items SET status = 4 WHERE rowid = ? AND status = 1", (edit.link_item_id,))
+    db.commit()
+
+
 def add_new_items_from_watch_dir(watch_dir: str, db: Database) -> bool:
     """
     Check for new items on disk, and if there are, populate DB with them.
@@ -110,7 +221,7 @@ def add_new_items_from_watch_dir(watch_dir: str, db: Database) -> bool:
         return False
 
     parsed_tsv = parse_tsv(input_file)
-    populate_db(parsed_tsv, db)
+    populate_db(parsed_tsv, db, source=Path(input_file).name, sha256=file_sha256(input_file))
     delete_file(input_file)
 
     return True
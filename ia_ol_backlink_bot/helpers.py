@@ -1,4 +1,5 @@
 import csv
+import hashlib
 from pathlib import Path
 from typing import Iterator
 
@@ -24,6 +25,16 @@ def delete_file(filename: str) -> None:
         file.unlink()
 
 
+def file_sha256(filename: str) -> str:
+    """Return the hex sha256 of the contents of {filename}, to recognise a file that's already been added."""
+    digest = hashlib.sha256()
+    with Path(filename).open(mode="rb") as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
 def parse_tsv(in_tsv: str) -> Iterator[BacklinkItemRow]:
     """
     Read TSV file in_tsv return an iterator for db.executemany().
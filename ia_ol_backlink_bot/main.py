@@ -4,35 +4,61 @@ Status values:
     0: needs updating
     1: this script updated it
     2: something else updated it.
+    3: there was an error processing it.
+    4: this script updated it, then rolled it back.
 """
+import argparse
 import csv
 import os
 import sqlite3
+import sys
 import time
-from collections import namedtuple
+from collections import Counter
+from functools import partial
 from pathlib import Path
 from threading import Thread
 from typing import Any, Iterator, NoReturn
 
-import uvicorn
-# uvicorn reads this.
-from api import app
 from olclient.openlibrary import OpenLibrary
-from requests.exceptions import HTTPError
+from requests.exceptions import HTTPError, RequestException
 
+from ia_ol_backlink_bot import constants
 # import requests
-from ia_ol_backlink_bot.constants import DB, DB_NAME, SETTINGS
+from ia_ol_backlink_bot.accounts import (AccountPool, BotAccount, Credentials,
+                                         get_account_pool, get_bot_credentials)
 from ia_ol_backlink_bot.database import (Database,
                                          add_new_items_from_watch_dir,
-                                         db_initalized,
+                                         create_history_tables, db_initalized,
+                                         file_imported,
                                          get_backitems_needing_update,
-                                         update_backlink_item_status)
-from ia_ol_backlink_bot.models import BacklinkItem, BacklinkItemRow
+                                         get_edits_to_roll_back, populate_db,
+                                         record_edit,
+                                         update_backlink_item_status,
+                                         update_rollback_status)
+from ia_ol_backlink_bot.helpers import file_sha256, parse_tsv
+from ia_ol_backlink_bot.models import BacklinkItem, BacklinkItemRow, EditRecord
 
 # Set in .env and load into the env via the shell, or docker-compose if using that.
 BASE_URL = os.environ["base_url"]
-BOT_USER = os.environ["bot_user"]
-BOT_PASSWORD = os.environ["bot_password"]
+# bot_user/bot_password, plus any bot_user_2/bot_password_2, etc. See accounts.get_bot_credentials().
+BOT_CREDENTIALS = get_bot_credentials()
+
+# For the batch summary. See update_backlink_item_status().
+STATUS_DESCRIPTIONS = {
+    0: "unprocessed",
+    1: "updated",
+    2: "already had an ocaid",
+    3: "errored",
+    4: "rolled back",
+}
+
+# For the rollback summary. See create_history_tables().
+ROLLBACK_STATUS_DESCRIPTIONS = {
+    1: "rolled back",
+    2: "changed by something else since, so left alone",
+    3: "errored",
+    4: "never saved, so nothing to undo",
+}
 
 
 def can_add_ocaid(edition: Any) -> bool:
@@ -44,8 +70,7 @@ def can_add_ocaid(edition: Any) -> bool:
 
 
 def get_ol_connection(user: str, password: str, base_url: str = "https://openlibrary.org") -> OpenLibrary:
-    C = namedtuple("Credentials", ["username", "password"])
-    credentials = C(user, password)
+    credentials = Credentials(user, password)
     return OpenLibrary(base_url=base_url, credentials=credentials)
 
 
@@ -55,38 +80,122 @@ def get_edition(id: str, ol: OpenLibrary) -> Any:
     return ol.Edition.get(id)
 
 
-def update_backlink_items(backlink_items: list[Any], ol: OpenLibrary, db: Database) -> None:
+def process_backlink_item(item: BacklinkItem, account: BotAccount, db_name: str) -> int:
     """
-    These should be Editions.
-    Go through each backlink_item and update it, both on Open Library, and in the local DB.
+    Update a single Edition on Open Library using {account}.
+    Returns the status to record in the local DB. See update_backlink_item_status().
+
+    What the Edition looked like beforehand is committed to edit_history before saving, so that
+    the edit can be rolled back even if this process dies before the status is recorded. The
+    sqlite3 connection can't be shared between threads, so this opens its own.
     """
-    for backlink_item in backlink_items:
-        _id, edition_id, ocaid, status = backlink_item
-        item = BacklinkItem(edition_id, ocaid, status, _id)
+    try:
+        edition = get_edition(item.edition_id, account.ol)
+    except RequestException:
+        return 3
 
-        try:
-            edition = get_edition(item.edition_id, ol)
-        except HTTPError:
-            update_backlink_item_status(status=3, rowid=item.id, db=db)
-            continue
+    print(f"Updating {edition.title} ({edition.olid}) -> ocaid: {item.ocaid}")
 
-        print(f"Updating {edition.title} ({edition.olid}) -> ocaid: {item.ocaid}")
+    if not can_add_ocaid(edition):
+        return 2
 
-        if can_add_ocaid(edition):
-            edition.ocaid = item.ocaid
-        else:
-            update_backlink_item_status(status=2, rowid=item.id, db=db)
-            continue
+    edit = EditRecord(
+        link_item_id=item.id,
+        edition_id=item.edition_id,
+        ocaid=item.ocaid,
+        prior_ocaid=getattr(edition, "ocaid", None),
+        prior_revision=getattr(edition, "revision", None),
+    )
+    with Database(name=db_name) as db:
+        record_edit(edit, db)
 
-        # if hasattr(edition, "source_records") and f"ia:{item.ocaid}" not in edition.source_records:
-        #     edition.source_records.append(f"ia:{item.ocaid}")
-        # else:
-        #     edition.source_records = [f"ia:{item.ocaid}"]
+    edition.ocaid = item.ocaid
 
-        edition.save(comment="Linking back to Internet Archive.")
-        update_backlink_item_status(status=1, rowid=item.id, db=db)
+    # if hasattr(edition, "source_records") and f"ia:{item.ocaid}" not in edition.source_records:
+    #     edition.source_records.append(f"ia:{item.ocaid}")
+    # else:
+    #     edition.source_records = [f"ia:{item.ocaid}"]
 
-        time.sleep(float(SETTINGS["ocaid_add_delay"]))
+    try:
+        account.save(edition, comment="Linking back to Internet Archive.")
+    except RequestException:
+        return 3
+
+    return 1
+
+
+def rollback_edit(edit: EditRecord, account: BotAccount) -> int:
+    """
+    Restore the ocaid an Edition had before this script edited it, using {account}.
+    Returns the rollback_status to record. See create_history_tables().
+    """
+    try:
+        edition = get_edition(edit.edition_id, account.ol)
+    except RequestException:
+        return 3
+
+    current_ocaid = getattr(edition, "ocaid", None)
+    current_revision = getattr(edition, "revision", None)
+    if (current_ocaid or "") == (edit.prior_ocaid or ""):
+        # The edit was recorded, but the save failed or never happened.
+        if edit.prior_revision is not None and current_revision == edit.prior_revision:
+            return 4
+        # E.g. an interrupted rollback saved this edition but didn't get to record it.
+        return 1
+    # Leave alone anything changed by someone else since: either the ocaid, or, if there's a
+    # revision to go by, anything else after this script's save.
+    if current_ocaid != edit.ocaid:
+        return 2
+    if edit.prior_revision is not None and current_revision is not None and current_revision != edit.prior_revision + 1:
+        return 2
+
+    print(f"Rolling back {edition.title} ({edition.olid}) -> ocaid: {edit.prior_ocaid!r}")
+    if edit.prior_ocaid is None:
+        del edition.ocaid
+    else:
+        edition.ocaid = edit.prior_ocaid
+
+    try:
+        account.save(edition, comment="Reverting link back to Internet Archive.")
+    except RequestException:
+        return 3
+
+    return 1
+
+
+def process_backlink_items(
+    items: list[BacklinkItem], account: BotAccount, db_name: str
+) -> list[tuple[BacklinkItem, int]]:
+    """
+    Process {items}, which are all for the same Edition, in order using {account}, so that each
+    sees the Edition as saved by the one before it. See process_backlink_item().
+    """
+    return [(item, process_backlink_item(item, account, db_name)) for item in items]
+
+
+def update_backlink_items(backlink_items: list[Any], pool: AccountPool, db: Database) -> Counter[int]:
+    """
+    These should be Editions.
+    Go through each backlink_item and update it, both on Open Library, and in the local DB.
+    Returns a count of the resulting statuses.
+
+    The Open Library edits are spread across the accounts in {pool}, and each status is recorded
+    on this thread as its edit finishes. Items for the same Edition (e.g. duplicate rows) are
+    handled one after another by the same account; otherwise both could see no ocaid and both save.
+    """
+    editions: dict[str, list[BacklinkItem]] = {}
+    for _id, edition_id, ocaid, status in backlink_items:
+        editions.setdefault(edition_id, []).append(BacklinkItem(edition_id, ocaid, status, _id))
+    create_history_tables(db)
+    db.commit()
+
+    statuses: Counter[int] = Counter()
+    for _, results in pool.map(partial(process_backlink_items, db_name=db.name), editions.values()):
+        for item, status in results:
+            update_backlink_item_status(status=status, rowid=item.id, db=db)
+            statuses[status] += 1
+
+    return statuses
 
 
 class WatchAndProcessItems(Thread):
@@ -102,10 +211,10 @@ class WatchAndProcessItems(Thread):
     Note: this is only its own class to inherit from Thread.
     """
 
-    def __init__(self, watch_dir: str, ol: OpenLibrary, db_name: str) -> None:
+    def __init__(self, watch_dir: str, pool: AccountPool, db_name: str) -> None:
         Thread.__init__(self)
         self.watch_dir = watch_dir
-        self.ol = ol
+        self.pool = pool
         self.db_name = db_name
 
     def run(self):
@@ -121,7 +230,7 @@ class WatchAndProcessItems(Thread):
 
             if existing_items:
                 print("Found existing items to update. Updating them now.")
-                update_backlink_items(existing_items, self.ol, db)
+                update_backlink_items(existing_items, self.pool, db)
 
         # Enter watch-mode and continually monitor the watch dir for new files/entries.
         while True:
@@ -136,29 +245,127 @@ class WatchAndProcessItems(Thread):
 
             if new_backlink_items:
                 print("Unprocessed items found. Updating.")
-                update_backlink_items(new_backlink_items, self.ol, db)
+                update_backlink_items(new_backlink_items, self.pool, db)
 
             time.sleep(10)
 
 
+def get_bot_pool() -> AccountPool:
+    """Log in each bot account. Change base_url here to tell olclient which host to use."""
+    delay = float(constants.SETTINGS["ocaid_add_delay"])
+    # pool = get_account_pool(BOT_CREDENTIALS, base_url="https://openlibrary.org", delay=delay)
+    pool = get_account_pool(BOT_CREDENTIALS, base_url="http://192.168.0.11:8080", delay=delay)
+    print(f"Logged in {len(pool)} bot account(s).")
+    return pool
+
+
+def batch(argv: list[str] | None = None) -> int:
+    """
+    One-shot entry point, e.g. for cron or CI.
+
+    Add the items in each input TSV to the database, update every item needing an update
+    (including any left over from earlier runs), print a summary, and exit. Unlike start(), this
+    neither watches watch_dir nor starts the API, and the input files are not deleted.
+
+    Files whose contents match an earlier batch are skipped, so re-running the same command (e.g.
+    after a crash) doesn't add every item again. Pass --force to add them anyway. A new file that
+    reuses an earlier file's name is added as usual.
+
+    Returns the exit status: 0 on success, 1 if any item errored, and 2 if an input file is missing.
+    """
+    parser = argparse.ArgumentParser(
+        prog="batch", description="Link the Open Library editions in TSV files of edition ID and OCAID pairs."
+    )
+    parser.add_argument("files", nargs="+", type=Path, help="TSV file(s) to process")
+    parser.add_argument("--force", action="store_true", help="add files even if already added by an earlier run")
+    args = parser.parse_args(argv)
+
+    if missing := [str(f) for f in args.files if not f.is_file()]:
+        print(f"No such file: {', '.join(missing)}", file=sys.stderr)
+        return 2
+
+    pool = get_bot_pool()
+    with Database(name=constants.DB_NAME) as db:
+        for f in args.files:
+            sha256 = file_sha256(str(f))
+            if file_imported(sha256, db) and not args.force:
+                print(f"Skipping {f}: its contents were already added by an earlier run. Use --force to add it again.")
+                continue
+
+            populate_db(parse_tsv(str(f)), db, source=f.name, sha256=sha256)
+
+        statuses = update_backlink_items(get_backitems_needing_update(db), pool, db)
+
+    summary = ", ".join(f"{count} {STATUS_DESCRIPTIONS[status]}" for status, count in sorted(statuses.items()))
+    print(f"Processed {sum(statuses.values())} item(s): {summary or 'nothing to do'}.")
+
+    return 1 if statuses[3] else 0
+
+
+def rollback(argv: list[str] | None = None) -> int:
+    """
+    Roll back the edits this script made, e.g. after a bad reconcile file.
+
+    Select the edits by the name of the file they came from, by batch_id (see the import_batches
+    table), or by a range of link_items rowids, then restore each Edition's prior ocaid, spread
+    across the bot accounts like any other edits. Progress is recorded as each edit is rolled
+    back, so re-running the same command after an interruption resumes where it left off.
+
+    Returns the exit status: 0 on success, and 1 if any edit failed to roll back.
+    """
+    parser = argparse.ArgumentParser(prog="rollback", description="Roll back ocaid edits made by this bot.")
+    selector = parser.add_mutually_exclusive_group(required=True)
+    selector.add_argument("--file", help="name of the input file (or 'api') the items came from")
+    selector.add_argument("--batch", type=int, help="batch_id from the import_batches table")
+    selector.add_argument("--rowids", type=int, nargs=2, metavar=("FIRST", "LAST"), help="inclusive rowid range")
+    args = parser.parse_args(argv)
+
+    with Database(name=constants.DB_NAME) as db:
+        if not db_initalized(db):
+            print("Nothing to roll back: the database has no backlink items.")
+            return 0
+
+        edits = get_edits_to_roll_back(
+            db,
+            source=Path(args.file).name if args.file else None,
+            batch_id=args.batch,
+            rowid_range=(args.rowids[0], args.rowids[1]) if args.rowids else None,
+        )
+        print(f"Found {len(edits)} edit(s) to roll back.")
+
+        statuses: Counter[int] = Counter()
+        if edits:
+            pool = get_bot_pool()
+            for edit, status in pool.map(rollback_edit, edits):
+                update_rollback_status(status=status, edit=edit, db=db)
+                statuses[status] += 1
+
+    summary = ", ".join(f"{count} {ROLLBACK_STATUS_DESCRIPTIONS[status]}" for status, count in sorted(statuses.items()))
+    print(f"Processed {sum(statuses.values())} edit(s): {summary or 'nothing to do'}.")
+
+    return 1 if statuses[3] else 0
+
+
 def start() -> None:
     """
     Main entry point.
 
-    Create watch dir if needed, get on openlibrary-client connection, monitor the watch dir,
+    Create watch dir if needed, log in each bot account, monitor the watch dir,
     repeatedly try to add any new or existing link items, and start up the API.
     """
-    watch_dir = SETTINGS["watch_dir"]
+    # Only the server needs uvicorn, so keep it out of batch runs.
+    import uvicorn
+
+    watch_dir = constants.SETTINGS["watch_dir"]
     d = Path(watch_dir)
     if not d.exists():
         d.mkdir()
 
-    # ol = get_ol_connection(user=BOT_USER, password=BOT_PASSWORD, base_url="https://openlibrary.org")
-    ol = get_ol_connection(user=BOT_USER, password=BOT_PASSWORD, base_url="http://192.168.0.11:8080")
-    watch_and_process_items = WatchAndProcessItems(watch_dir=watch_dir, ol=ol, db_name=DB_NAME)
+    pool = get_bot_pool()
+    watch_and_process_items = WatchAndProcessItems(watch_dir=watch_dir, pool=pool, db_name=constants.DB_NAME)
 
     # Monitor the watch dir and repeatdly try to add items on a thread so as not to block uvicorn.
     watch_and_process_items.start()
 
     # Load the API from api.py.
-    uvicorn.run("ia_ol_backlink_bot.main:app", host="0.0.0.0", port=5000, reload=True)
+    uvicorn.run("ia_ol_backlink_bot.api:app", host="0.0.0.0", port=5000, reload=True)
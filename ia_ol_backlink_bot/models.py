@@ -9,3 +9,14 @@ class BacklinkItem:
     ocaid: str
     status: int = 0
     id: int = 0
+
+
+@dataclass
+class EditRecord:
+    """An edit made by this script, and what the Edition looked like before it, so the edit can be rolled back."""
+
+    link_item_id: int
+    edition_id: str
+    ocaid: str
+    prior_ocaid: str | None = None
+    prior_revision: int | None = None
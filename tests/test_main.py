@@ -1,19 +1,34 @@
+import copy
 import os
+import threading
+import time
 from dataclasses import dataclass
 from pathlib import Path, PosixPath
 from typing import Iterable
 
 import pytest
 from olclient.openlibrary import OpenLibrary
+from requests import Response
+from requests.exceptions import ConnectionError, HTTPError
 
+from ia_ol_backlink_bot import accounts
+from ia_ol_backlink_bot.accounts import (AccountPool, BotAccount, Credentials,
+                                         RateLimiter, get_account_pool,
+                                         get_bot_credentials)
 from ia_ol_backlink_bot.api import api_key_hash_in_db
 # from ia_ol_backlink_bot.constants import SETTINGS
-from ia_ol_backlink_bot.database import Database, populate_db
-from ia_ol_backlink_bot.helpers import (delete_file, get_input_filename,
-                                        parse_tsv)
-from ia_ol_backlink_bot.main import (can_add_ocaid,
+from ia_ol_backlink_bot.database import (Database, create_history_tables,
+                                         file_imported, get_edits_to_roll_back,
+                                         populate_db, record_edit,
+                                         update_backlink_item_status,
+                                         update_rollback_status)
+from ia_ol_backlink_bot.helpers import (delete_file, file_sha256,
+                                        get_input_filename, parse_tsv)
+from ia_ol_backlink_bot.main import (batch, can_add_ocaid,
                                      get_backitems_needing_update, get_edition,
-                                     get_ol_connection, update_backlink_items)
+                                     get_ol_connection, process_backlink_item,
+                                     rollback_edit, update_backlink_items)
+from ia_ol_backlink_bot.models import BacklinkItem, EditRecord
 
 USER = os.environ["test_user"]
 PASSWORD = os.environ["test_password"]
@@ -25,12 +40,43 @@ class FakeEdition:
     title: str = "Blob"
 
 
+class FakeOpenLibrary:
+    """Stands in for olclient's OpenLibrary so BotAccount doesn't log in to a real server."""
+
+    def __init__(self, base_url: str, credentials: Credentials) -> None:
+        self.logins = 1
+
+    def login(self, credentials: Credentials) -> None:
+        self.logins += 1
+
+
+class FailingEdition(FakeEdition):
+    """An Edition whose save() raises HTTPError with each of {status_codes} in turn, then succeeds."""
+
+    def __init__(self, *status_codes: int) -> None:
+        self.status_codes = list(status_codes)
+        self.saves = 0
+
+    def save(self, comment: str) -> None:
+        self.saves += 1
+        if self.status_codes:
+            response = Response()
+            response.status_code = self.status_codes.pop(0)
+            raise HTTPError(response=response)
+
+
 @pytest.fixture(scope="session")
 def get_ol() -> Iterable[OpenLibrary]:
     ol = get_ol_connection(user=USER, password=PASSWORD, base_url="http://localhost:8080")
     yield ol
 
 
+@pytest.fixture(scope="session")
+def get_pool() -> Iterable[AccountPool]:
+    pool = get_account_pool([Credentials(USER, PASSWORD)], base_url="http://localhost:8080", delay=0)
+    yield pool
+
+
 @pytest.fixture(scope="session")
 def get_db(get_ol, tmp_path_factory) -> Iterable[Database]:
     d = tmp_path_factory.mktemp("data")
@@ -137,7 +183,7 @@ def test_populate_db(get_db: Database) -> None:
     assert db.query("""SELECT * FROM link_items""") == expected
 
 
-def test_update_backlink_items(get_ol: OpenLibrary, get_db: Database) -> None:
+def test_update_backlink_items(get_ol: OpenLibrary, get_pool: AccountPool, get_db: Database) -> None:
     db = get_db
     ol = get_ol
     expected = [
@@ -146,8 +192,15 @@ def test_update_backlink_items(get_ol: OpenLibrary, get_db: Database) -> None:
         (3, "OL24755423M", "odysseybookiv00home", 2),
     ]
 
+    # What alice and gulliver look like before the edits that should be recorded in edit_history.
+    before = [get_edition(olid, ol) for olid in ("OL13517105M", "OL24173003M")]
+    expected_history = [
+        (1, getattr(before[0], "ocaid", None), before[0].revision),
+        (2, getattr(before[1], "ocaid", None), before[1].revision),
+    ]
+
     if unprocessed_items := get_backitems_needing_update(db):
-        update_backlink_items(backlink_items=unprocessed_items, ol=ol, db=db)
+        update_backlink_items(backlink_items=unprocessed_items, pool=get_pool, db=db)
 
     alice = get_edition("OL13517105M", ol)
     gulliver = get_edition("OL24173003M", ol)
@@ -163,6 +216,279 @@ def test_update_backlink_items(get_ol: OpenLibrary, get_db: Database) -> None:
     assert odyssey.source_records == ["ia:odysseybookiv00home"]
 
     assert db.query("SELECT * FROM link_items") == expected
+    assert db.query("SELECT link_item_id, prior_ocaid, prior_revision FROM edit_history") == expected_history
+
+
+def test_get_bot_credentials() -> None:
+    """Additional accounts are numbered from 2, and numbering stops at the first gap."""
+    environ = {
+        "bot_user": "first",
+        "bot_password": "first_pw",
+        "bot_user_2": "second",
+        "bot_password_2": "second_pw",
+        "bot_user_4": "skipped",
+        "bot_password_4": "skipped_pw",
+    }
+    assert get_bot_credentials(environ) == [Credentials("first", "first_pw"), Credentials("second", "second_pw")]
+
+
+def test_get_edits_to_roll_back(tmp_path) -> None:
+    """Edits can be selected by source, batch or rowid range, and are skipped once rolled back."""
+    db = Database(name=tmp_path / "sqlite_db")
+    populate_db(iter([("OL1M", "first_a", 0), ("OL2M", "first_b", 0)]), db, source="first.tsv")
+    populate_db(iter([("OL3M", "second_a", 0)]), db, source="second.tsv")
+
+    edits = [
+        EditRecord(1, "OL1M", "first_a", "", 3),
+        EditRecord(2, "OL2M", "first_b", None, 7),
+        EditRecord(3, "OL3M", "second_a", None, None),
+    ]
+    for edit in edits:
+        record_edit(edit, db)
+    # The edit is recorded before saving, so OL3M's status may never have been recorded.
+    update_backlink_item_status(status=1, rowid=1, db=db)
+    update_backlink_item_status(status=1, rowid=2, db=db)
+
+    assert get_edits_to_roll_back(db, source="first.tsv") == edits[:2]
+    assert get_edits_to_roll_back(db, batch_id=2) == edits[2:]
+    assert get_edits_to_roll_back(db, rowid_range=(2, 3)) == edits[1:]
+
+    update_rollback_status(status=1, edit=edits[0], db=db)
+    assert get_edits_to_roll_back(db, source="first.tsv") == edits[1:2]
+    assert db.query("SELECT status FROM link_items WHERE rowid = 1") == [(4,)]
+
+    # Errored rollbacks are retried; edits changed elsewhere since are not.
+    update_rollback_status(status=3, edit=edits[1], db=db)
+    update_rollback_status(status=2, edit=edits[2], db=db)
+    assert get_edits_to_roll_back(db, rowid_range=(1, 3)) == edits[1:2]
+
+    # Only items this script updated are marked as rolled back, so e.g. an error isn't overwritten.
+    update_backlink_item_status(status=3, rowid=2, db=db)
+    update_rollback_status(status=1, edit=edits[1], db=db)
+    assert db.query("SELECT status FROM link_items WHERE rowid = 2") == [(3,)]
+
+
+def fake_edition(olid: str, revision: int, **fields: str) -> FakeEdition:
+    edition = FakeEdition()
+    edition.olid = olid
+    edition.revision = revision
+    for field, value in fields.items():
+        setattr(edition, field, value)
+
+    return edition
+
+
+class FakeAccount:
+    """
+    Stands in for a BotAccount and the server behind it, serving copies of {editions} by olid.
+    Saving stores a copy with the next revision, and records what was saved.
+    """
+
+    def __init__(
+        self, *editions: FakeEdition, get_error: Exception | None = None, save_error: Exception | None = None
+    ) -> None:
+        self.editions = {edition.olid: edition for edition in editions}
+        self.get_error = get_error
+        self.save_error = save_error
+        self.saved: list[FakeEdition] = []
+        # get_edition() calls ol.Edition.get().
+        self.ol = self.Edition = self
+
+    def get(self, olid: str) -> FakeEdition:
+        if self.get_error is not None:
+            raise self.get_error
+        if olid not in self.editions:
+            response = Response()
+            response.status_code = 404
+            raise HTTPError(response=response)
+        return copy.copy(self.editions[olid])
+
+    def save(self, edition: FakeEdition, comment: str) -> None:
+        if self.save_error is not None:
+            raise self.save_error
+        self.saved.append(edition)
+        saved = copy.copy(edition)
+        saved.revision = self.editions[edition.olid].revision + 1
+        self.editions[edition.olid] = saved
+
+
+class SlowAccount(FakeAccount):
+    """A FakeAccount that's slow to get, so that concurrent calls overlap."""
+
+    def get(self, olid: str) -> FakeEdition:
+        time.sleep(0.05)
+        return super().get(olid)
+
+
+def test_process_backlink_item_records_edit_before_save(tmp_path) -> None:
+    db_name = str(tmp_path / "sqlite_db")
+    db = Database(name=db_name)
+    populate_db(iter([("OL1M", "new_ocaid", 0), ("OL2M", "other_ocaid", 0), ("OL3M", "missing", 0)]), db)
+    create_history_tables(db)
+    db.commit()
+
+    class CheckingAccount(FakeAccount):
+        def save(self, edition: FakeEdition, comment: str) -> None:
+            with Database(name=db_name) as other_db:
+                assert other_db.query("SELECT * FROM edit_history") == [(1, "OL1M", "new_ocaid", None, 5, 0)]
+            super().save(edition, comment)
+
+    account = CheckingAccount(fake_edition("OL1M", 5), fake_edition("OL2M", 2, ocaid="existing"))
+    assert process_backlink_item(BacklinkItem("OL1M", "new_ocaid", id=1), account, db_name) == 1
+    assert account.saved[0].ocaid == "new_ocaid"
+    assert process_backlink_item(BacklinkItem("OL2M", "other_ocaid", id=2), account, db_name) == 2
+    assert process_backlink_item(BacklinkItem("OL3M", "missing", id=3), account, db_name) == 3
+
+    account = FakeAccount(fake_edition("OL1M", 5), save_error=ConnectionError())
+    assert process_backlink_item(BacklinkItem("OL1M", "new_ocaid", id=1), account, db_name) == 3
+
+
+def test_update_backlink_items_duplicate_edition(tmp_path) -> None:
+    """Rows for the same Edition are handled in order, so only the first adds an ocaid."""
+    db = Database(name=str(tmp_path / "sqlite_db"))
+    populate_db(iter([("OL1M", "first", 0), ("OL1M", "second", 0), ("OL2M", "other", 0)]), db)
+    # Both "accounts" share one server.
+    account = SlowAccount(fake_edition("OL1M", 5), fake_edition("OL2M", 1))
+    pool = AccountPool([account, account])
+
+    update_backlink_items(get_backitems_needing_update(db), pool, db)
+
+    assert db.query("SELECT rowid, status FROM link_items ORDER BY rowid") == [(1, 1), (2, 2), (3, 1)]
+    assert account.editions["OL1M"].ocaid == "first"
+    assert account.editions["OL1M"].revision == 6
+
+    # And so the edit can be rolled back.
+    edits = get_edits_to_roll_back(db, rowid_range=(1, 3))
+    assert [edit.link_item_id for edit in edits] == [1, 3]
+    assert [rollback_edit(edit, account) for edit in edits] == [1, 1]
+    assert not hasattr(account.editions["OL1M"], "ocaid")
+
+
+def test_rollback_edit() -> None:
+    edit = EditRecord(1, "OL1M", "bot_ocaid", prior_ocaid=None, prior_revision=5)
+
+    # Restore the missing ocaid field by removing it.
+    account = FakeAccount(fake_edition("OL1M", 6, ocaid="bot_ocaid"))
+    assert rollback_edit(edit, account) == 1
+    assert not hasattr(account.saved[0], "ocaid")
+
+    # Restore an empty ocaid.
+    account = FakeAccount(fake_edition("OL1M", 6, ocaid="bot_ocaid"))
+    assert rollback_edit(EditRecord(1, "OL1M", "bot_ocaid", prior_ocaid="", prior_revision=5), account) == 1
+    assert account.saved[0].ocaid == ""
+
+    # Never saved, so nothing to undo.
+    account = FakeAccount(fake_edition("OL1M", 5))
+    assert rollback_edit(edit, account) == 4
+    assert account.saved == []
+
+    # Already restored by an earlier, interrupted, rollback.
+    account = FakeAccount(fake_edition("OL1M", 7))
+    assert rollback_edit(edit, account) == 1
+    assert account.saved == []
+
+    # Changed by something else since, either the ocaid or another field.
+    account = FakeAccount(fake_edition("OL1M", 7, ocaid="someone_elses_ocaid"))
+    assert rollback_edit(edit, account) == 2
+    account = FakeAccount(fake_edition("OL1M", 7, ocaid="bot_ocaid"))
+    assert rollback_edit(edit, account) == 2
+    assert account.saved == []
+
+    # Errors getting or saving the edition.
+    assert rollback_edit(edit, FakeAccount()) == 3
+    assert rollback_edit(edit, FakeAccount(fake_edition("OL1M", 6), get_error=ConnectionError())) == 3
+    account = FakeAccount(fake_edition("OL1M", 6, ocaid="bot_ocaid"), save_error=ConnectionError())
+    assert rollback_edit(edit, account) == 3
+
+
+def test_rate_limiter_spaces_calls_by_delay() -> None:
+    limiter = RateLimiter(delay=0.05)
+    start = time.monotonic()
+    for _ in range(4):
+        limiter.wait()
+
+    assert time.monotonic() - start >= 0.15
+
+
+def test_account_pool_map_one_call_per_account() -> None:
+    """Every item is processed, with at most one call in flight per account."""
+    pool = AccountPool(["first", "second"])
+    in_flight: dict[str, int] = {"first": 0, "second": 0}
+    most_in_flight: dict[str, int] = {"first": 0, "second": 0}
+    lock = threading.Lock()
+
+    def work(item: int, account: str) -> int:
+        with lock:
+            in_flight[account] += 1
+            most_in_flight[account] = max(most_in_flight[account], in_flight[account])
+        time.sleep(0.01)
+        with lock:
+            in_flight[account] -= 1
+        return item * 2
+
+    assert sorted(pool.map(work, range(10))) == [(i, i * 2) for i in range(10)]
+    assert most_in_flight == {"first": 1, "second": 1}
+
+
+def test_account_pool_map_yields_other_results_before_raising() -> None:
+    pool = AccountPool(["first", "second", "third"])
+
+    def work(item: int, account: str) -> int:
+        if item == 0:
+            raise ValueError("boom")
+        return item
+
+    results = []
+    with pytest.raises(ValueError):
+        for result in pool.map(work, range(6)):
+            results.append(result)
+
+    assert sorted(results) == [(i, i) for i in range(1, 6)]
+
+
+def test_account_pool_map_stops_when_the_caller_does() -> None:
+    """Only the calls already in flight run once the caller stops consuming results."""
+    pool = AccountPool(["first", "second"])
+    calls = []
+
+    def work(item: int, account: str) -> int:
+        calls.append(item)
+        time.sleep(0.01)
+        return item
+
+    results = pool.map(work, range(40))
+    next(results)
+    results.close()
+
+    assert len(calls) <= 3
+
+
+def test_bot_account_save_logs_in_again_on_expired_session(monkeypatch) -> None:
+    """A 401 or 403 leads to one login() and one rate limited retry. Other errors, or a second failure, re-raise."""
+    monkeypatch.setattr(accounts, "OpenLibrary", FakeOpenLibrary)
+    account = BotAccount(Credentials("user", "password"), base_url="http://localhost:8080", delay=0)
+    waits = []
+    account.rate_limiter.wait = lambda: waits.append(1)
+
+    for status_code in (401, 403):
+        edition = FailingEdition(status_code)
+        account.save(edition, comment="test")
+        assert edition.saves == 2
+
+    # The retry waits on the rate limiter too.
+    assert len(waits) == 4
+
+    assert account.ol.logins == 3
+
+    edition = FailingEdition(500)
+    with pytest.raises(HTTPError):
+        account.save(edition, comment="test")
+    assert edition.saves == 1
+
+    edition = FailingEdition(401, 401)
+    with pytest.raises(HTTPError):
+        account.save(edition, comment="test")
+    assert edition.saves == 2
 
 
 def test_get_input_filename(tmp_path) -> None:
@@ -189,6 +515,27 @@ def test_get_input_filename(tmp_path) -> None:
     assert input_file == ""
 
 
+def test_batch_missing_file(tmp_path) -> None:
+    """batch() should exit with status 2, without logging in, when an input file doesn't exist."""
+    assert batch([str(tmp_path / "missing.tsv")]) == 2
+
+
+def test_file_imported(tmp_path) -> None:
+    """Files are recognised by their contents, not their name."""
+    db = Database(name=tmp_path / "sqlite_db")
+    first = tmp_path / "reconcile_output.tsv"
+    first.write_text("OL1M\tfirst_a")
+    first_sha256 = file_sha256(str(first))
+    assert file_imported(first_sha256, db) is False
+
+    populate_db(parse_tsv(str(first)), db, source=first.name, sha256=first_sha256)
+    assert file_imported(first_sha256, db) is True
+
+    # E.g. the next day's output, written to the same name.
+    first.write_text("OL2M\tsecond_a")
+    assert file_imported(file_sha256(str(first)), db) is False
+
+
 ### web API tests
 def test_api_key_hash_in_db(tmp_path) -> None:
     d: Path = tmp_path